@@ -6,19 +6,331 @@ IMAP дубликаты писем - многопоточное удаление
 """
 
 import imaplib
-import email
-from email.header import decode_header
-from email.message import Message
 import hashlib
 from collections import defaultdict
+from array import array
 import threading
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
-from typing import List, Dict, Set, Tuple
+from typing import List, Dict, Set, Tuple, Iterator, Iterable, Callable, Sequence, Optional
 import re
 import sys
 import getpass
 import base64
+import functools
+import math
+import calendar
+from datetime import timezone
+from email.header import decode_header
+from email.utils import parsedate_to_datetime
+import os
+import sqlite3
+from contextlib import closing
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Строка LIST: (\Flags) "delimiter" "folder_name"
+_FOLDER_RE1 = re.compile(r'\([^)]*\)\s+"([^"]*)"\s+"([^"]*)"')
+# Альтернативный формат без кавычек вокруг имени папки
+_FOLDER_RE2 = re.compile(r'\([^)]*\)\s+"([^"]*)"\s+(\S+)')
+# Число писем в ответе STATUS: b'"INBOX" (MESSAGES 231)'
+_STATUS_MESSAGES_RE = re.compile(rb'\bMESSAGES (\d+)')
+# Закодированный участок модифицированного UTF-7: &...-
+_IMAP_UTF7_RE = re.compile(r'&([^-]*)-')
+# UID письма в ответе UID FETCH: b'<n> (UID <uid> BODY[...] {size}' или b' UID <uid>)'
+_FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+# Заголовок и его значение вместе со строками-продолжениями
+_HDR_RE = re.compile(
+    rb'^(From|Subject|Date|Message-ID):[ \t]*([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)',
+    re.M | re.I
+)
+# Префиксы ответа и пересылки в начале Subject (кириллица в UTF-8, re.I для неё не работает)
+_REPLY_PREFIXES = ['re', 'fwd?'] + [
+    variant for word in ('ответ', 'пересл') for variant in (word, word.capitalize(), word.upper())
+]
+_REPLY_PREFIX_RE = re.compile(
+    r'^(?:\s*(?:{})\s*:\s*)+'.format('|'.join(_REPLY_PREFIXES)).encode('utf-8'),
+    re.I
+)
+# Дата в обычной записи RFC 5322: "Mon, 1 Jan 2024 10:00:00 +0000"
+_MONTHS = (b'jan', b'feb', b'mar', b'apr', b'may', b'jun',
+           b'jul', b'aug', b'sep', b'oct', b'nov', b'dec')
+_DATE_RE = re.compile(
+    rb'^\s*(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+(%s)\s+(\d{4})\s+(\d{2}):(\d{2})(?::(\d{2}))?\s+([+-])(\d{2})(\d{2})'
+    % b'|'.join(_MONTHS),
+    re.I
+)
+# 64-битный хеш: для ключа словаря внутри папки криптостойкость не нужна.
+# xxh3 заметно быстрее, без него - BLAKE2b из стандартной библиотеки.
+# Версия алгоритма (_HASH_SCHEME): при изменении кеш прошлых запусков сбрасывается.
+# xxh3 появился в xxhash 2.0, со старыми версиями тоже берём BLAKE2b
+_xxh3_64 = getattr(xxhash, 'xxh3_64', None) if xxhash is not None else None
+if _xxh3_64 is not None:
+    _new_hasher = _xxh3_64
+    _HASH_SCHEME = 'xxh3-64:v6'
+else:
+    _new_hasher = functools.partial(hashlib.blake2b, digest_size=8, usedforsecurity=False)
+    _HASH_SCHEME = 'blake2b-64:v6'
+
+# Кеш хешей писем между запусками
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'imap_dedupe.sqlite')
+
+# Общая блокировка вывода: строки разных потоков не перемешиваются
+_print_lock = threading.Lock()
+
+
+def _print(*args, **kwargs):
+    """print() под общей блокировкой вывода"""
+    with _print_lock:
+        print(*args, **kwargs)
+
+
+def _decode_imap_utf7_part(match: re.Match) -> str:
+    """Декодирует один участок &...- (base64 с ',' вместо '/', UTF-16-BE)"""
+    encoded_part = match.group(1)
+    if not encoded_part:
+        return '&'
+    try:
+        encoded_part = encoded_part.replace(',', '/') + '=' * (-len(encoded_part) % 4)
+        return base64.b64decode(encoded_part).decode('utf-16-be')
+    except Exception:
+        return match.group(0)
+
+
+@functools.lru_cache(maxsize=4096)
+def _decode_imap_utf7(folder_name: str) -> str:
+    """Декодирует модифицированный UTF-7, результат кешируется"""
+    if '&' not in folder_name:
+        return folder_name
+    return _IMAP_UTF7_RE.sub(_decode_imap_utf7_part, folder_name)
+
+
+def _substring_re(patterns: Sequence[str]) -> re.Pattern:
+    """Регулярное выражение «содержит одну из подстрок» без учёта регистра"""
+    lowered = {pattern.lower() for pattern in patterns}
+    # Шаблон, внутри которого есть более короткий ('[gmail]/trash' и 'trash'), ничего не добавляет
+    minimal = sorted(p for p in lowered if not any(q != p and q in p for q in lowered))
+    return re.compile('|'.join(map(re.escape, minimal)), re.IGNORECASE)
+
+
+def _uid_set(uids: Sequence[int]) -> str:
+    """Собирает набор UID для команды IMAP, сжимая подряд идущие номера: 1:5,7,9:12"""
+    ranges = []
+    start = prev = None
+    for uid in sorted(uids):
+        if prev is not None and uid - prev <= 1:
+            prev = uid
+            continue
+        if start is not None:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = uid
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ','.join(ranges)
+
+
+def _normalize_date(value: bytes, _match=_DATE_RE.match) -> bytes:
+    """Date как метка времени UTC: одна и та же дата в разной записи даёт одно значение"""
+    # Быстрый путь для обычной записи: parsedate_to_datetime втрое медленнее
+    match = _match(value)
+    if match is not None:
+        day, month, year, hour, minute, second, sign, tz_hours, tz_minutes = match.groups()
+        year, month, day = int(year), _MONTHS.index(month.lower()) + 1, int(day)
+        hour, minute, second = int(hour), int(minute), int(second or 0)
+        tz_hours = int(tz_hours)
+        # Невозможные значения (32 Jan, 25:61) timegm молча переносит дальше,
+        # а годы меньше 100 медленный путь считает двузначными: такие даты отдаём ему
+        if (year >= 100 and day >= 1 and (day <= 28 or day <= calendar.monthrange(year, month)[1])
+                and hour < 24 and minute < 60 and second < 60 and tz_hours < 24):
+            offset = tz_hours * 3600 + int(tz_minutes) * 60
+            ts = calendar.timegm((year, month, day, hour, minute, second))
+            return b'%d' % (ts - offset if sign == b'+' else ts + offset)
+    try:
+        date = parsedate_to_datetime(value.decode('ascii', 'replace'))
+        if date.tzinfo is None:
+            # "-0000" и даты без пояса считаем UTC, а не локальным временем машины
+            date = date.replace(tzinfo=timezone.utc)
+        return b'%d' % int(date.timestamp())
+    except Exception:
+        # Нормализация не должна падать: неразборчивую дату хешируем как есть
+        return value
+
+
+def _decode_encoded_words(value: bytes) -> bytes:
+    """Раскрывает слова RFC 2047 (=?utf-8?B?...?=) в UTF-8, чтобы были видны префиксы вроде Ответ:"""
+    try:
+        parts = decode_header(value.decode('utf-8', 'replace'))
+        return ''.join(
+            part.decode(charset or 'ascii', 'replace') if isinstance(part, bytes) else part
+            for part, charset in parts
+        ).encode('utf-8')
+    except Exception:
+        # Битые слова (HeaderParseError и т.п.): нормализация не должна падать
+        return value
+
+
+def _normalize_subject(value: bytes) -> bytes:
+    """Subject без префиксов Re:/Fwd:/Ответ: в начале"""
+    # Закодированные слова раскрываем только когда они есть: это дорого
+    if b'=?' in value:
+        value = _decode_encoded_words(value)
+    return _REPLY_PREFIX_RE.sub(b'', value, count=1)
+
+
+def _normalize_message_id(value: bytes) -> bytes:
+    """Message-ID без учёта регистра"""
+    return value.lower()
+
+
+# Поля, которые перед хешированием приводятся к единому виду
+_HDR_NORMALIZERS = {
+    b'date': _normalize_date,
+    b'subject': _normalize_subject,
+    b'message-id': _normalize_message_id,
+}
+# Место поля в хеше: порядок фиксирован и не зависит от порядка заголовков в письме
+_HDR_SLOTS = {b'from': 0, b'subject': 1, b'date': 2, b'message-id': 3}
+# Отметка отсутствующего поля, чтобы оно не совпадало с пустым
+_MISSING_HDR = b'\xff\xff\xff\xff'
+
+
+def hash_headers(raw_headers: bytes, _findall=_HDR_RE.findall, _new_hasher=_new_hasher,
+                 _normalizers=_HDR_NORMALIZERS, _slots=_HDR_SLOTS) -> int:
+    """Хеш письма по сырым байтам заголовков From/Subject/Date/Message-ID"""
+    values = [None] * len(_slots)
+    for name, value in _findall(raw_headers):
+        name = name.lower()
+        slot = _slots[name]
+        # Повторы поля игнорируем: учитывается первое вхождение
+        if values[slot] is not None:
+            continue
+        normalize = _normalizers.get(name)
+        if normalize is not None:
+            value = normalize(value)
+        # Пробелы и переносы строк (folding) убираем
+        values[slot] = b''.join(value.split())
+    # Значения с длиной впереди: границы полей однозначны
+    msg_hash = _new_hasher()
+    update = msg_hash.update
+    for value in values:
+        if value is None:
+            update(_MISSING_HDR)
+        else:
+            update(len(value).to_bytes(4, 'big'))
+            update(value)
+    # Число вместо bytes - ключ словаря без лишнего хеширования;
+    # 63 бита, чтобы помещаться в INTEGER SQLite
+    return int.from_bytes(msg_hash.digest(), 'big') >> 1
+
+
+class _BloomFilter:
+    """Фильтр Блума по готовым 63-битным хешам писем (~1.2 байта на элемент при 1% ошибок)"""
+    
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def check_and_add(self, key: int) -> bool:
+        """Добавляет ключ, возвращает True, если он (возможно) уже был"""
+        # Ключ уже равномерно распределён - позиции получаем двойным хешированием из его половин
+        step = (key >> 32) | 1
+        position = key & 0xFFFFFFFF
+        bits = self.bits
+        seen = True
+        for _ in range(self.hash_count):
+            index = position % self.size
+            mask = 1 << (index & 7)
+            if not bits[index >> 3] & mask:
+                seen = False
+                bits[index >> 3] |= mask
+            position += step
+        return seen
+
+
+class HashCache:
+    """Кеш хешей писем в SQLite, чтобы не скачивать заголовки заново при следующем запуске"""
+    
+    # Версия структуры таблиц: при изменении кеш пересоздаётся, как и при смене хеша
+    SCHEMA_VERSION = 2
+    
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        with closing(self._open()) as db, db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            
+            # Хеши другого алгоритма несравнимы с новыми - начинаем с чистого кеша
+            scheme = f"{_HASH_SCHEME};schema={self.SCHEMA_VERSION}"
+            row = db.execute("SELECT value FROM meta WHERE key = 'hash_scheme'").fetchone()
+            if row is None or row[0] != scheme:
+                db.execute('DROP TABLE IF EXISTS folders')
+                db.execute('DROP TABLE IF EXISTS messages')
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('hash_scheme', ?)", (scheme,))
+            
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS folders ('
+                'account TEXT, folder TEXT, uidvalidity INTEGER, '
+                'PRIMARY KEY(account, folder))'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'account TEXT, folder TEXT, uid INTEGER, hash INTEGER, '
+                'PRIMARY KEY(account, folder, uid))'
+            )
+    
+    def _open(self) -> sqlite3.Connection:
+        # Отдельное соединение на каждый вызов: их нельзя делить между потоками
+        return sqlite3.connect(self.path, timeout=30)
+    
+    def load(self, account: str, folder: str, uidvalidity: int) -> Optional[Tuple[array, array]]:
+        """Возвращает UID по возрастанию и их хеши прошлого запуска
+        или None, если кеша нет или UIDVALIDITY сменился"""
+        with closing(self._open()) as db:
+            row = db.execute(
+                'SELECT uidvalidity FROM folders WHERE account = ? AND folder = ?',
+                (account, folder)
+            ).fetchone()
+            if row is None or row[0] != uidvalidity:
+                return None
+            
+            # Параллельные массивы вместо словаря: ~12 байт на письмо, а не ~140
+            uids = array('I')
+            hashes = array('Q')
+            for uid, msg_hash in db.execute(
+                'SELECT uid, hash FROM messages WHERE account = ? AND folder = ? ORDER BY uid',
+                (account, folder)
+            ):
+                uids.append(uid)
+                hashes.append(msg_hash)
+            return uids, hashes
+    
+    def save(self, account: str, folder: str, uidvalidity: int, reset: bool,
+             added: Iterable[Tuple[int, int]], removed: Iterable[int]):
+        """Обновляет кеш папки: добавляет пары (uid, хеш) и убирает исчезнувшие UID.
+        reset - старые записи папки недействительны и удаляются целиком"""
+        with closing(self._open()) as db, db:
+            if reset:
+                db.execute('DELETE FROM messages WHERE account = ? AND folder = ?', (account, folder))
+                db.execute(
+                    'INSERT OR REPLACE INTO folders VALUES (?, ?, ?)',
+                    (account, folder, uidvalidity)
+                )
+            db.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)',
+                ((account, folder, uid, msg_hash) for uid, msg_hash in added)
+            )
+            db.executemany(
+                'DELETE FROM messages WHERE account = ? AND folder = ? AND uid = ?',
+                ((account, folder, uid) for uid in removed)
+            )
+
 
 class IMAPDuplicateRemover:
     # Папки, которые нужно пропустить (на разных языках)
@@ -28,9 +340,21 @@ class IMAPDuplicateRemover:
         '[gmail]/trash', '[gmail]/spam', '[gmail]/drafts',
         'deleted items', 'deleted messages', 'junk email'
     ]
+    # Все шаблоны одним регулярным выражением без учёта регистра
+    _SKIP_RE = _substring_re(SKIP_FOLDERS)
+    
+    # Заголовки, по которым считается хеш (PEEK не ставит флаг \Seen)
+    FETCH_HEADERS = '(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)])'
+    # Сколько писем запрашивать одной командой FETCH
+    FETCH_BATCH_SIZE = 500
+    # Сколько соединений на папку использовать для чтения заголовков
+    FETCH_CONNECTIONS = 4
+    # Как часто обновлять строку прогресса, секунд
+    PROGRESS_INTERVAL = 0.25
     
     def __init__(self, host: str, username: str, password: str, 
-                 port: int = 993, use_ssl: bool = True, num_threads: int = 4):
+                 port: int = 993, use_ssl: bool = True, num_threads: int = 4,
+                 cache_path: Optional[str] = DEFAULT_CACHE_PATH):
         """
         Инициализация удаления дубликатов IMAP
         
@@ -41,6 +365,7 @@ class IMAPDuplicateRemover:
             port: Порт (по умолчанию 993 для SSL)
             use_ssl: Использовать SSL
             num_threads: Количество потоков
+            cache_path: Файл кеша хешей между запусками (None - без кеша)
         """
         self.host = host
         self.username = username
@@ -49,6 +374,20 @@ class IMAPDuplicateRemover:
         self.use_ssl = use_ssl
         self.num_threads = num_threads
         self.lock = threading.Lock()
+        # Постоянные соединения потоков пула: по одному на поток
+        self.local = threading.local()
+        self.worker_connections = {}
+        # Ограничение на дополнительные соединения для чтения заголовков
+        self.fetch_slots = threading.BoundedSemaphore(num_threads * self.FETCH_CONNECTIONS)
+        self.account = f"{username}@{host}"
+        # Включён ли UTF8=ACCEPT (None - ещё не подключались)
+        self.utf8_names = None
+        self.cache = None
+        if cache_path:
+            try:
+                self.cache = HashCache(cache_path)
+            except (OSError, sqlite3.Error) as e:
+                _print(f"⚠️  Кеш недоступен, работаем без него: {e}")
         self.stats = {
             'total_messages': 0,
             'duplicates_found': 0,
@@ -65,55 +404,48 @@ class IMAPDuplicateRemover:
                 mail = imaplib.IMAP4(self.host, self.port)
             
             mail.login(self.username, self.password)
+            self.refresh_capabilities(mail)
+            
+            # UTF8=ACCEPT (RFC 6855): имена папок приходят в UTF-8, без модифицированного UTF-7.
+            # Проверяем по списку после входа: до входа серверы его обычно не называют.
+            # Режим выбирается по первому соединению и одинаков для всех остальных
+            if self.utf8_names is not False:
+                utf8_enabled = False
+                if 'UTF8=ACCEPT' in mail.capabilities and 'ENABLE' in mail.capabilities:
+                    try:
+                        typ, data = mail.enable('UTF8=ACCEPT')
+                        utf8_enabled = typ == 'OK'
+                    except imaplib.IMAP4.error:
+                        pass
+                if self.utf8_names is None:
+                    self.utf8_names = utf8_enabled
+                elif not utf8_enabled:
+                    raise imaplib.IMAP4.error("сервер не включил UTF8=ACCEPT")
             return mail
         except Exception as e:
-            print(f"❌ Ошибка подключения: {e}")
+            _print(f"❌ Ошибка подключения: {e}")
             raise
     
+    @staticmethod
+    def refresh_capabilities(mail: imaplib.IMAP4_SSL):
+        """Перечитывает CAPABILITY после входа: imaplib хранит список, полученный до входа"""
+        # Dovecot, Gmail и другие до входа показывают не всё (UIDPLUS, UNSELECT, UTF8=ACCEPT)
+        try:
+            typ, data = mail.capability()
+        except imaplib.IMAP4.error:
+            return
+        if typ == 'OK' and data and data[-1]:
+            mail.capabilities = tuple(data[-1].decode('ascii', 'replace').upper().split())
+    
     def decode_folder_name(self, folder_name: str) -> str:
         """Декодирует имя папки из модифицированного UTF-7 (IMAP)"""
-        try:
-            if '&' in folder_name:
-                decoded = ''
-                i = 0
-                while i < len(folder_name):
-                    if folder_name[i] == '&':
-                        end = folder_name.find('-', i)
-                        if end == -1:
-                            end = len(folder_name)
-                        
-                        if end == i + 1:
-                            decoded += '&'
-                            i = end + 1
-                        else:
-                            encoded_part = folder_name[i+1:end]
-                            try:
-                                encoded_part = encoded_part.replace(',', '/')
-                                padding = (4 - len(encoded_part) % 4) % 4
-                                encoded_part += '=' * padding
-                                decoded_bytes = base64.b64decode(encoded_part)
-                                decoded += decoded_bytes.decode('utf-16-be')
-                            except:
-                                decoded += folder_name[i:end+1]
-                            i = end + 1
-                    else:
-                        decoded += folder_name[i]
-                        i += 1
-                return decoded
-            else:
-                return folder_name
-        except Exception as e:
+        if self.utf8_names:
             return folder_name
+        return _decode_imap_utf7(folder_name)
     
     def should_skip_folder(self, folder_name: str) -> bool:
         """Проверяет, нужно ли пропустить папку"""
-        folder_lower = folder_name.lower()
-        
-        for skip_pattern in self.SKIP_FOLDERS:
-            if skip_pattern in folder_lower:
-                return True
-        
-        return False
+        return self._SKIP_RE.search(folder_name) is not None
     
     def get_folders(self, mail: imaplib.IMAP4_SSL, skip_system: bool = True) -> List[str]:
         """Получает список всех папок"""
@@ -123,25 +455,22 @@ class IMAPDuplicateRemover:
             if status == 'OK':
                 for folder_info in folder_list:
                     try:
-                        folder_line = folder_info.decode('ascii', errors='ignore')
+                        folder_line = folder_info.decode('utf-8' if self.utf8_names else 'ascii', errors='ignore')
                         
                         # DEBUG: показываем что парсим (первые 3 папки)
                         if len(folders) < 3:
-                            print(f"  DEBUG RAW: {folder_line}")
+                            _print(f"  DEBUG RAW: {folder_line}")
                         
-                        # Regex для парсинга: (\Flags) "delimiter" "folder_name"
-                        pattern1 = r'\([^\)]*\)\s+"([^"]*)"\s+"([^"]*)"'
-                        match = re.search(pattern1, folder_line)
+                        match = _FOLDER_RE1.search(folder_line)
                         
                         if match:
                             delimiter = match.group(1)
                             folder_name = match.group(2)
                             if len(folders) < 3:
-                                print(f"  DEBUG PARSED: delimiter='{delimiter}', folder='{folder_name}'")
+                                _print(f"  DEBUG PARSED: delimiter='{delimiter}', folder='{folder_name}'")
                         else:
                             # Альтернативный формат без кавычек
-                            pattern2 = r'\([^\)]*\)\s+"([^"]*)"\s+(\S+)'
-                            match = re.search(pattern2, folder_line)
+                            match = _FOLDER_RE2.search(folder_line)
                             if match:
                                 delimiter = match.group(1)
                                 folder_name = match.group(2).strip()
@@ -154,7 +483,7 @@ class IMAPDuplicateRemover:
                         decoded_name = self.decode_folder_name(folder_name)
                         
                         if skip_system and self.should_skip_folder(decoded_name):
-                            print(f"  ⏭️  Пропускаю: {decoded_name}")
+                            _print(f"  ⏭️  Пропускаю: {decoded_name}")
                             continue
                         
                         folders.append(folder_name)
@@ -163,233 +492,490 @@ class IMAPDuplicateRemover:
                         continue
                         
         except Exception as e:
-            print(f"❌ Ошибка получения списка папок: {e}")
+            _print(f"❌ Ошибка получения списка папок: {e}")
         
         return folders
     
-    def decode_header_value(self, header_value: str) -> str:
-        """Декодирует значение заголовка письма"""
-        if not header_value:
-            return ""
+    def get_folder_sizes(self, mail: imaplib.IMAP4_SSL, folders: List[str]) -> Dict[str, int]:
+        """Число писем в каждой папке по STATUS (MESSAGES); папки с ошибкой пропускаются"""
+        sizes = {}
+        for folder_name in folders:
+            try:
+                status, data = mail.status('"{}"'.format(folder_name), '(MESSAGES)')
+                if status != 'OK':
+                    continue
+                match = _STATUS_MESSAGES_RE.search(data[0])
+                if match:
+                    sizes[folder_name] = int(match.group(1))
+            except imaplib.IMAP4.abort:
+                raise
+            except Exception as e:
+                continue
+        return sizes
+    
+    def select_folder(self, mail: imaplib.IMAP4_SSL, folder_name: str, readonly: bool) -> str:
+        """Выбирает папку, возвращает статус ответа SELECT"""
+        # Выбираем папку используя оригинальное имя В КАВЫЧКАХ
+        status = 'NO'
         
-        decoded_parts = []
         try:
-            for part, encoding in decode_header(header_value):
-                if isinstance(part, bytes):
-                    if encoding:
-                        try:
-                            decoded_parts.append(part.decode(encoding))
-                        except:
-                            decoded_parts.append(part.decode('utf-8', errors='ignore'))
-                    else:
-                        decoded_parts.append(part.decode('utf-8', errors='ignore'))
+            # IMAP требует имя папки в кавычках если есть пробелы или спецсимволы
+            status, messages = mail.select('"{}"'.format(folder_name), readonly=readonly)
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            # Если не получилось с кавычками, пробуем без
+            try:
+                status, messages = mail.select(folder_name, readonly=readonly)
+            except:
+                pass
+        
+        return status
+    
+    def fetch_headers(self, mail: imaplib.IMAP4_SSL, message_ids: Sequence[int]) -> Iterator[Tuple[int, bytes]]:
+        """Одной командой UID FETCH забирает заголовки пачки писем, отдаёт пары (UID, заголовки)"""
+        status, msg_data = mail.uid('FETCH', _uid_set(message_ids), self.FETCH_HEADERS)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"FETCH вернул {status}")
+        
+        # Ответ: кортежи (b'<n> (UID <uid> BODY[...] {size}', b'<заголовки>') вперемешку с b')'.
+        # Некоторые серверы присылают UID после заголовков: b' UID <uid>)'
+        pending_headers = None
+        for item in msg_data:
+            if isinstance(item, tuple):
+                match = _FETCH_UID_RE.search(item[0])
+                if match:
+                    yield int(match.group(1)), item[1]
+                    pending_headers = None
                 else:
-                    decoded_parts.append(str(part))
-        except:
-            return str(header_value)
-        
-        return ''.join(decoded_parts)
-    
-    def get_message_hash(self, msg: Message) -> str:
-        """Создаёт хеш письма"""
-        from_header = self.decode_header_value(msg.get('From', ''))
-        subject = self.decode_header_value(msg.get('Subject', ''))
-        date = msg.get('Date', '')
-        message_id = msg.get('Message-ID', '')
-        
-        unique_str = f"{from_header}|{subject}|{date}|{message_id}"
-        return hashlib.md5(unique_str.encode('utf-8')).hexdigest()
-    
-    def process_folder(self, folder_name: str, dry_run: bool = False) -> Dict:
-        """Обрабатывает одну папку и находит дубликаты"""
-        mail = None
-        folder_stats = {
+                    pending_headers = item[1]
+            elif pending_headers is not None and item:
+                match = _FETCH_UID_RE.search(item)
+                if match:
+                    yield int(match.group(1)), pending_headers
+                pending_headers = None
+    
+    def hash_messages(self, mail: imaplib.IMAP4_SSL, message_ids: Sequence[int],
+                      on_progress: Callable[[int], None]) -> Tuple[array, array, int]:
+        """Считает хеши писем пачками FETCH, возвращает массивы UID и хешей и число ошибок"""
+        uids = array('I')
+        keys = array('Q')
+        errors = 0
+        
+        # Горячий цикл: без поиска методов через self на каждом письме
+        append_uid = uids.append
+        append_key = keys.append
+        
+        for start in range(0, len(message_ids), self.FETCH_BATCH_SIZE):
+            batch = message_ids[start:start + self.FETCH_BATCH_SIZE]
+            try:
+                count = len(uids)
+                for msg_id, raw_headers in self.fetch_headers(mail, batch):
+                    # Сначала ключ, потом оба значения: при ошибке массивы не разъезжаются,
+                    # а плохие заголовки стоят одного письма, а не всей пачки
+                    try:
+                        key = hash_headers(raw_headers)
+                    except Exception:
+                        errors += 1
+                        continue
+                    append_uid(msg_id)
+                    append_key(key)
+                on_progress(len(uids) - count)
+            except imaplib.IMAP4.abort:
+                raise
+            except Exception as e:
+                errors += 1
+        
+        return uids, keys, errors
+    
+    def hash_shard(self, folder_name: str, message_ids: Sequence[int],
+                   on_progress: Callable[[int], None]) -> Tuple[array, array, int]:
+        """Считает хеши части папки через отдельное соединение (только чтение)"""
+        with self.fetch_slots:
+            mail = self.connect()
+            try:
+                if self.select_folder(mail, folder_name, readonly=True) != 'OK':
+                    raise imaplib.IMAP4.error(f"не удалось открыть папку {folder_name}")
+                return self.hash_messages(mail, message_ids, on_progress)
+            finally:
+                try:
+                    mail.logout()
+                except:
+                    pass
+    
+    def hash_folder(self, mail: imaplib.IMAP4_SSL, folder_name: str, message_ids: Sequence[int],
+                    on_progress: Callable[[int], None]) -> Tuple[array, array, int]:
+        """Считает хеши всех писем папки, большие папки делятся между несколькими соединениями"""
+        if len(message_ids) <= self.FETCH_BATCH_SIZE or self.FETCH_CONNECTIONS < 2:
+            return self.hash_messages(mail, message_ids, on_progress)
+        
+        shard_size = -(-len(message_ids) // self.FETCH_CONNECTIONS)
+        shards = [message_ids[i:i + shard_size] for i in range(0, len(message_ids), shard_size)]
+        shard_results = [None] * len(shards)
+        
+        def run_shard(index: int):
+            try:
+                shard_results[index] = self.hash_shard(folder_name, shards[index], on_progress)
+            except Exception as e:
+                # Сервер не дал ещё одно соединение - досчитаем через основное
+                pass
+        
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            list(executor.map(run_shard, range(len(shards))))
+        
+        uids = array('I')
+        keys = array('Q')
+        errors = 0
+        for shard, result in zip(shards, shard_results):
+            if result is None:
+                result = self.hash_messages(mail, shard, on_progress)
+            uids.extend(result[0])
+            keys.extend(result[1])
+            errors += result[2]
+        
+        return uids, keys, errors
+    
+    @staticmethod
+    def find_duplicates(uids: array, keys: array) -> array:
+        """UID дубликатов: в каждой группе с одинаковым хешем остаётся письмо с меньшим UID"""
+        # Первый проход: фильтр Блума отбирает хеши, которые, возможно, уже встречались.
+        # Память - около байта на письмо вместо словаря по всем хешам папки
+        bloom = _BloomFilter(len(keys))
+        candidates = set()
+        for key in keys:
+            if bloom.check_and_add(key):
+                candidates.add(key)
+        
+        # Второй проход: точная группировка только по кандидатам,
+        # ложные срабатывания фильтра дают группу из одного письма и не удаляются
+        groups: Dict[int, array] = defaultdict(lambda: array('I'))
+        if candidates:
+            for uid, key in zip(uids, keys):
+                if key in candidates:
+                    groups[key].append(uid)
+        
+        to_delete = array('I')
+        for ids in groups.values():
+            if len(ids) > 1:
+                first = min(ids)
+                to_delete.extend(uid for uid in ids if uid != first)
+        return to_delete
+    
+    def delete_messages(self, mail: imaplib.IMAP4_SSL, message_ids: Sequence[int]) -> Tuple[int, int]:
+        """Помечает письма \\Deleted пачками UID STORE и удаляет их, возвращает (удалено, ошибок)"""
+        message_ids = sorted(message_ids)
+        deleted = array('I')
+        errors = 0
+        
+        for start in range(0, len(message_ids), self.FETCH_BATCH_SIZE):
+            batch = message_ids[start:start + self.FETCH_BATCH_SIZE]
+            try:
+                # .SILENT: сервер не присылает новые флаги по каждому письму
+                status, _ = mail.uid('STORE', _uid_set(batch), '+FLAGS.SILENT', '\\Deleted')
+                if status != 'OK':
+                    raise imaplib.IMAP4.error(f"STORE вернул {status}")
+                deleted.extend(batch)
+            except imaplib.IMAP4.abort:
+                raise
+            except Exception as e:
+                errors += 1
+        
+        if deleted:
+            if 'UIDPLUS' in mail.capabilities:
+                # UID EXPUNGE удаляет только наши письма, а не всё помеченное \Deleted
+                for start in range(0, len(deleted), self.FETCH_BATCH_SIZE):
+                    mail.uid('EXPUNGE', _uid_set(deleted[start:start + self.FETCH_BATCH_SIZE]))
+            else:
+                mail.expunge()
+        
+        return len(deleted), errors
+    
+    @staticmethod
+    def get_response_number(mail: imaplib.IMAP4_SSL, code: str) -> Optional[int]:
+        """Достаёт число из кода ответа SELECT, например [UIDVALIDITY 123]"""
+        typ, data = mail.response(code)
+        try:
+            return int(data[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+    
+    def load_cached_hashes(self, folder_name: str, uidvalidity: Optional[int]) -> Optional[Tuple[array, array]]:
+        """UID и хеши папки из кеша прошлого запуска, если UIDVALIDITY не изменился (иначе None)"""
+        if self.cache is None or uidvalidity is None:
+            return None
+        try:
+            return self.cache.load(self.account, folder_name, uidvalidity)
+        except sqlite3.Error as e:
+            _print(f"⚠️  Ошибка чтения кеша: {e}")
+            return None
+    
+    def save_cached_hashes(self, folder_name: str, uidvalidity: Optional[int], reset: bool,
+                           added: Iterable[Tuple[int, int]], removed: Iterable[int]):
+        """Дописывает в кеш новые хеши папки и убирает исчезнувшие письма"""
+        if self.cache is None or uidvalidity is None:
+            return
+        try:
+            self.cache.save(self.account, folder_name, uidvalidity, reset, added, removed)
+        except sqlite3.Error as e:
+            _print(f"⚠️  Ошибка записи кеша: {e}")
+    
+    @staticmethod
+    def empty_folder_stats(folder_name: str) -> Dict:
+        """Пустая статистика по папке"""
+        return {
             'folder': folder_name,
             'total': 0,
             'duplicates': 0,
             'deleted': 0,
             'errors': 0
         }
+    
+    def process_folder(self, mail: imaplib.IMAP4_SSL, folder_name: str, dry_run: bool = False) -> Dict:
+        """Обрабатывает одну папку через переданное соединение и находит дубликаты"""
+        folder_stats = self.empty_folder_stats(folder_name)
         
         try:
-            mail = self.connect()
             display_name = self.decode_folder_name(folder_name)
             
-            # Выбираем папку используя оригинальное имя В КАВЫЧКАХ
-            status = 'NO'
-            
-            try:
-                # IMAP требует имя папки в кавычках если есть пробелы или спецсимволы
-                status, messages = mail.select('"{}"'.format(folder_name), readonly=False)
-            except Exception as e:
-                # Если не получилось с кавычками, пробуем без
-                try:
-                    status, messages = mail.select(folder_name, readonly=False)
-                except:
-                    pass
+            status = self.select_folder(mail, folder_name, readonly=dry_run)
             
             if status != 'OK':
-                print(f"❌ Не удалось открыть папку: {display_name}")
-                print(f"   DEBUG: Имя для IMAP: {folder_name}")
+                _print(f"❌ Не удалось открыть папку: {display_name}")
+                _print(f"   DEBUG: Имя для IMAP: {folder_name}")
                 return folder_stats
             
-            status, msg_nums = mail.search(None, 'ALL')
+            uidvalidity = self.get_response_number(mail, 'UIDVALIDITY')
+            cached = self.load_cached_hashes(folder_name, uidvalidity)
+            cache_reset = cached is None
+            
+            # Список писем всегда берём у сервера: кешу доверяем только хеши,
+            # иначе письмо, удалённое другим клиентом, сошло бы за оставляемую копию.
+            # Работаем с UID: они не сдвигаются между соединениями, в отличие от номеров писем
+            status, msg_nums = mail.uid('SEARCH', None, 'ALL')
             if status != 'OK':
                 return folder_stats
             
-            message_ids = msg_nums[0].split()
+            # UID как 32-битные числа, а не отдельные объекты bytes на каждое письмо
+            # По возрастанию для слияния с кешем; обычно сервер так и отдаёт, и sorted почти бесплатен
+            message_ids = array('I', sorted(map(int, msg_nums[0].split())))
             folder_stats['total'] = len(message_ids)
             
-            print(f"\n📁 Папка: {display_name}")
-            print(f"   Всего писем: {len(message_ids)}")
+            _print(f"\n📁 Папка: {display_name}")
+            _print(f"   Всего писем: {len(message_ids)}")
             
             if len(message_ids) == 0:
-                print(f"   ℹ️  Папка пустая, пропускаем")
+                _print(f"   ℹ️  Папка пустая, пропускаем")
                 return folder_stats
             
-            hash_to_ids = defaultdict(list)
+            # Заголовки писем не меняются, поэтому скачиваем только новые UID.
+            # UID и хеши храним параллельными массивами: ~12 байт на письмо
+            uids = array('I')
+            keys = array('Q')
+            to_fetch = array('I')
+            # UID из кеша, которых нет на сервере: письма удалены
+            removed = array('I')
+            cached_uids, cached_keys = cached or (array('I'), array('Q'))
+            del cached
+            # Слияние двух отсортированных списков UID: сервера и кеша
+            pos = 0
+            cached_count = len(cached_uids)
+            for uid in message_ids:
+                while pos < cached_count and cached_uids[pos] < uid:
+                    removed.append(cached_uids[pos])
+                    pos += 1
+                if pos < cached_count and cached_uids[pos] == uid:
+                    uids.append(uid)
+                    keys.append(cached_keys[pos])
+                    pos += 1
+                else:
+                    to_fetch.append(uid)
+            removed.extend(cached_uids[pos:])
+            del cached_uids, cached_keys
+            if uids:
+                _print(f"   💾 Из кеша: {len(uids)}")
             
-            processed = 0
-            for msg_id in message_ids:
-                try:
-                    status, msg_data = mail.fetch(msg_id, '(RFC822)')
-                    if status != 'OK':
-                        continue
-                    
-                    raw_email = msg_data[0][1]
-                    msg = email.message_from_bytes(raw_email)
-                    
-                    msg_hash = self.get_message_hash(msg)
-                    hash_to_ids[msg_hash].append(msg_id)
-                    
-                    processed += 1
-                    if processed % 50 == 0:
-                        print(f"   📊 Обработано: {processed}/{len(message_ids)}", end='\r')
-                    
-                except Exception as e:
-                    folder_stats['errors'] += 1
+            progress = {'processed': 0, 'printed_at': 0.0}
+            
+            def report_progress(count: int):
+                with self.lock:
+                    progress['processed'] += count
+                    # Не чаще PROGRESS_INTERVAL, чтобы потоки не толкались за вывод
+                    now = time.monotonic()
+                    if now - progress['printed_at'] < self.PROGRESS_INTERVAL:
+                        return
+                    progress['printed_at'] = now
+                    processed = progress['processed']
+                _print(f"   📊 Обработано: {processed}/{len(to_fetch)}", end='\r')
+            
+            fetched_uids = array('I')
+            fetched_keys = array('Q')
+            if to_fetch:
+                fetched_uids, fetched_keys, errors = self.hash_folder(mail, folder_name, to_fetch, report_progress)
+                folder_stats['errors'] += errors
+                uids.extend(fetched_uids)
+                keys.extend(fetched_keys)
             
-            if processed > 0:
-                print(f"   📊 Обработано: {processed}/{len(message_ids)}")
+            if progress['processed'] > 0:
+                _print(f"   📊 Обработано: {progress['processed']}/{len(to_fetch)}")
             
-            duplicates_count = 0
+            to_delete = self.find_duplicates(uids, keys)
+            
+            duplicates_count = len(to_delete)
             deleted_count = 0
             
-            for msg_hash, ids in hash_to_ids.items():
-                if len(ids) > 1:
-                    duplicates_count += len(ids) - 1
-                    
-                    for duplicate_id in ids[1:]:
-                        if not dry_run:
-                            try:
-                                mail.store(duplicate_id, '+FLAGS', '\\Deleted')
-                                deleted_count += 1
-                            except Exception as e:
-                                folder_stats['errors'] += 1
+            if not dry_run and to_delete:
+                deleted_count, errors = self.delete_messages(mail, to_delete)
+                folder_stats['errors'] += errors
+                # Неудалённые письма просто перечитаются в следующий раз
+                removed.extend(to_delete)
             
-            if not dry_run and deleted_count > 0:
-                mail.expunge()
+            # В кеш пишем только изменения: новые хеши и исчезнувшие UID
+            if cache_reset or fetched_uids or removed:
+                self.save_cached_hashes(
+                    folder_name, uidvalidity, cache_reset,
+                    zip(fetched_uids, fetched_keys), removed
+                )
             
             folder_stats['duplicates'] = duplicates_count
             folder_stats['deleted'] = deleted_count
             
             if duplicates_count > 0:
-                print(f"   ✅ Найдено дубликатов: {duplicates_count}")
+                _print(f"   ✅ Найдено дубликатов: {duplicates_count}")
                 if not dry_run:
-                    print(f"   🗑️  Удалено: {deleted_count}")
+                    _print(f"   🗑️  Удалено: {deleted_count}")
             else:
-                print(f"   ✨ Дубликатов не найдено")
+                _print(f"   ✨ Дубликатов не найдено")
             
+        except imaplib.IMAP4.abort:
+            # Соединение оборвалось - решение о повторе принимает worker
+            raise
         except Exception as e:
             display_name = self.decode_folder_name(folder_name)
-            print(f"❌ Ошибка обработки папки {display_name}: {e}")
+            _print(f"❌ Ошибка обработки папки {display_name}: {e}")
             folder_stats['errors'] += 1
         finally:
-            if mail:
-                try:
+            # Закрываем папку, но не соединение: оно нужно для следующих папок.
+            # CLOSE в режиме записи удаляет все письма с \Deleted, в том числе
+            # помеченные не нами, поэтому предпочитаем UNSELECT; без него папка
+            # остаётся выбранной до следующего SELECT/LOGOUT, которые не удаляют писем
+            try:
+                if 'UNSELECT' in mail.capabilities:
+                    mail.unselect()
+                elif dry_run:
                     mail.close()
+            except:
+                pass
+        
+        return folder_stats
+    
+    def process_folder_with_retry(self, mail: Optional[imaplib.IMAP4_SSL], folder_name: str,
+                                  dry_run: bool) -> Tuple[Optional[imaplib.IMAP4_SSL], Dict]:
+        """Обрабатывает папку, при обрыве соединения переподключается и повторяет один раз"""
+        for attempt in range(2):
+            try:
+                if mail is None:
+                    mail = self.connect()
+                return mail, self.process_folder(mail, folder_name, dry_run)
+            except imaplib.IMAP4.abort as e:
+                display_name = self.decode_folder_name(folder_name)
+                _print(f"⚠️  Соединение оборвалось на папке {display_name}: {e}")
+                try:
                     mail.logout()
                 except:
                     pass
+                mail = None
+            except Exception as e:
+                break
         
-        return folder_stats
+        folder_stats = self.empty_folder_stats(folder_name)
+        folder_stats['errors'] += 1
+        return mail, folder_stats
     
-    def worker(self, queue: Queue, results: List, dry_run: bool):
-        """Рабочий поток для обработки папок"""
-        while True:
-            folder = queue.get()
-            if folder is None:
-                break
-            
-            result = self.process_folder(folder, dry_run)
-            
-            with self.lock:
-                results.append(result)
-                self.stats['total_messages'] += result['total']
-                self.stats['duplicates_found'] += result['duplicates']
-                self.stats['duplicates_deleted'] += result['deleted']
-                self.stats['errors'] += result['errors']
-            
-            queue.task_done()
+    def process_folder_in_pool(self, folder_name: str, dry_run: bool) -> Dict:
+        """Задача пула: обрабатывает папку через постоянное соединение текущего потока"""
+        mail = getattr(self.local, 'mail', None)
+        mail, result = self.process_folder_with_retry(mail, folder_name, dry_run)
+        self.local.mail = mail
+        
+        with self.lock:
+            self.worker_connections[threading.get_ident()] = mail
+        return result
+    
+    def close_worker_connections(self):
+        """Закрывает постоянные соединения потоков пула"""
+        with self.lock:
+            connections = list(self.worker_connections.values())
+            self.worker_connections.clear()
+        
+        for mail in connections:
+            if mail:
+                try:
+                    mail.logout()
+                except:
+                    pass
     
     def remove_duplicates(self, folders: List[str] = None, dry_run: bool = False, skip_system: bool = True):
         """Удаляет дубликаты из указанных папок"""
         mode_text = "ПРОВЕРКА" if dry_run else "УДАЛЕНИЕ"
         
-        print("\n" + "=" * 70)
-        print(f"🔍 IMAP Поиск дубликатов писем - Режим: {mode_text}")
-        print("=" * 70)
+        _print("\n" + "=" * 70)
+        _print(f"🔍 IMAP Поиск дубликатов писем - Режим: {mode_text}")
+        _print("=" * 70)
         
-        print("\n📂 Подключение к серверу...")
+        _print("\n📂 Подключение к серверу...")
         mail = self.connect()
-        print("✅ Подключено успешно!")
+        _print("✅ Подключено успешно!")
         
         if folders is None:
-            print(f"\n📋 Получение списка папок...")
+            _print(f"\n📋 Получение списка папок...")
             folders = self.get_folders(mail, skip_system=skip_system)
         
+        # Самые большие папки запускаем первыми, чтобы в конце не ждать одну огромную
+        folder_sizes = self.get_folder_sizes(mail, folders)
+        folders = sorted(folders, key=lambda f: folder_sizes.get(f, 0), reverse=True)
+        
         mail.logout()
         
         if not folders:
-            print("\n⚠️  Не найдено папок для обработки!")
+            _print("\n⚠️  Не найдено папок для обработки!")
             return
         
-        print(f"\n📁 Найдено папок для обработки: {len(folders)}")
+        _print(f"\n📁 Найдено папок для обработки: {len(folders)}")
         for i, folder in enumerate(folders, 1):
             display_name = self.decode_folder_name(folder)
-            print(f"   {i}. {display_name}")
+            if folder in folder_sizes:
+                _print(f"   {i}. {display_name} ({folder_sizes[folder]})")
+            else:
+                _print(f"   {i}. {display_name}")
         
-        queue = Queue()
         results = []
-        threads = []
-        
-        print(f"\n🚀 Запуск обработки ({self.num_threads} потоков)...")
         
-        for i in range(min(self.num_threads, len(folders))):
-            t = threading.Thread(target=self.worker, args=(queue, results, dry_run))
-            t.start()
-            threads.append(t)
+        _print(f"\n🚀 Запуск обработки ({self.num_threads} потоков)...")
         
-        for folder in folders:
-            queue.put(folder)
-        
-        queue.join()
-        
-        for i in range(len(threads)):
-            queue.put(None)
-        for t in threads:
-            t.join()
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.num_threads, len(folders))) as executor:
+                futures = [executor.submit(self.process_folder_in_pool, folder, dry_run) for folder in folders]
+                
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    self.stats['total_messages'] += result['total']
+                    self.stats['duplicates_found'] += result['duplicates']
+                    self.stats['duplicates_deleted'] += result['deleted']
+                    self.stats['errors'] += result['errors']
+        finally:
+            self.close_worker_connections()
         
-        print("\n" + "=" * 70)
-        print("📊 ИТОГОВАЯ СТАТИСТИКА")
-        print("=" * 70)
-        print(f"📧 Всего писем обработано: {self.stats['total_messages']}")
-        print(f"🔍 Найдено дубликатов: {self.stats['duplicates_found']}")
+        _print("\n" + "=" * 70)
+        _print("📊 ИТОГОВАЯ СТАТИСТИКА")
+        _print("=" * 70)
+        _print(f"📧 Всего писем обработано: {self.stats['total_messages']}")
+        _print(f"🔍 Найдено дубликатов: {self.stats['duplicates_found']}")
         if not dry_run:
-            print(f"🗑️  Удалено дубликатов: {self.stats['duplicates_deleted']}")
+            _print(f"🗑️  Удалено дубликатов: {self.stats['duplicates_deleted']}")
         if self.stats['errors'] > 0:
-            print(f"⚠️  Ошибок: {self.stats['errors']}")
-        print("=" * 70)
+            _print(f"⚠️  Ошибок: {self.stats['errors']}")
+        _print("=" * 70)
 
 
 def print_menu():